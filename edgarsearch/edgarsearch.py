@@ -25,9 +25,16 @@ Todo:
     *  Add silent option
 
 """
+import collections
 import datetime
+import multiprocessing as mp
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import edgarsearch.indexhandler as ih
 import edgarsearch.filingsbatch as fb
+import edgarsearch.mpworker as mpw
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
@@ -44,8 +51,9 @@ class Search(object):
             Default to -1.
         filter_formtype (list of str, optional): Filter based on filings type.
             Example:["8-K, 10-K"]. Defaults to None.
-        filter_CIK (list of str, optional):Filter based on CIK.
-            Example: ["12345678", "98765432"]. Defaults to None.
+        filter_CIK (list of str or int, optional):Filter based on CIK.
+            Example: ["12345678", "98765432"]. Stored as a set of int.
+            Defaults to None.
         dir_work (str): Working subdirectory for all saved data.
             Defaults to "edgar/".
         sub_index (str): Subdirectory in dir_work for saved index data.
@@ -54,13 +62,21 @@ class Search(object):
             Defaults to "filings".
         edgar_url (str): URL to EDGAR server
             Defaults to  "https://www.sec.gov/Archives/".
+        seed (int, optional): Seed for drawing the sample. Defaults to None.
+        user_agent (str): User-Agent header sent to the EDGAR server. SEC
+            asks automated tools to declare themselves, ideally with a
+            contact address. Defaults to "edgarsearch" and the project URL.
+        max_rate (float, optional): Maximum number of requests per second
+            sent to the EDGAR server, which throttles clients above 10.
+            None disables the limit. Defaults to 8.
 
     """
 
     def __init__(self, sample_start, sample_end, sample_size=-1, *,
                  filter_formtype=None, filter_CIK=None, dir_work="edgar/",
                  sub_index="index/", sub_filings="filings/",
-                 edgar_url="https://www.sec.gov/Archives/"):
+                 edgar_url="https://www.sec.gov/Archives/", seed=None,
+                 user_agent=mpw.USER_AGENT, max_rate=8):
         """Create new EDGAR search object."""
         self.dir_work = dir_work
         self.sub_index = sub_index
@@ -78,8 +94,33 @@ class Search(object):
         self.sample_start = sample_start
         self.sample_end = sample_end
         self.filter_formtype = filter_formtype
+        # CIKs are compared as integers, which isin can look up in a hash table
+        if filter_CIK is not None:
+            filter_CIK = set(int(cik) for cik in filter_CIK)
         self.filter_CIK = filter_CIK
         self.sample_size = sample_size
+        self.rng = np.random.default_rng(seed)
+        self._doc_parts = []
+        # Filtered indices of earlier download_index calls, valid as long as
+        # the index files have the fingerprint they had when consolidated
+        self._filter_cache = collections.OrderedDict()
+        self._index_fingerprint = None
+
+        # One session for all requests, shared by the download threads
+        self.session = mpw.make_session(user_agent=user_agent,
+                                        max_rate=max_rate, pool_maxsize=10)
+
+    @property
+    def docs(self):
+        """pandas dataframe: Documents stored by the last download.
+
+        The documents are kept as one DataFrame per chunk and only
+        concatenated when this property is read.
+
+        """
+        if self._doc_parts:
+            return pd.concat(self._doc_parts)
+        return pd.DataFrame()
 
     def download_index(self):
         """Download the index of the corresponding search.
@@ -96,22 +137,50 @@ class Search(object):
         """
         e_index = ih.EdgarIndex(self.sample_start, self.sample_end,
                                 self.dir_work, self.sub_index,
-                                self.edgar_url)
+                                self.edgar_url, self.session)
+        # Only sends requests for index files which are missing
         e_index.download()
-        e_index.consolidate()
-        self.full_index = e_index.cons_index
-        e_index.filter(self.sample_start, self.sample_end,
-                       self.filter_formtype,
-                       self.filter_CIK)
-        filt_index = e_index.filtered_index
+        # Consolidate again only if an index file of the sample changed, the
+        # filter results are only valid for the same index
+        fingerprint = e_index.fingerprint()
+        if fingerprint != self._index_fingerprint:
+            e_index.consolidate()
+            self.full_index = e_index.cons_index
+            self._index_fingerprint = fingerprint
+            self._filter_cache.clear()
+        else:
+            e_index.cons_index = self.full_index
+
+        # Reuse the result if the index was filtered the same way before
+        key = (self.sample_start, self.sample_end,
+               None if self.filter_formtype is None
+               else tuple(self.filter_formtype),
+               None if self.filter_CIK is None
+               else frozenset(self.filter_CIK))
+        if key in self._filter_cache:
+            self._filter_cache.move_to_end(key)
+            filt_index = self._filter_cache[key]
+        else:
+            e_index.filter(self.sample_start, self.sample_end,
+                           self.filter_formtype,
+                           self.filter_CIK)
+            filt_index = e_index.filtered_index
+            self._filter_cache[key] = filt_index
+            # Only keep the most recent results to bound the memory usage
+            if len(self._filter_cache) > 16:
+                self._filter_cache.popitem(last=False)
 
         if self.sample_size > 0:
-            self.cur_index = filt_index.sample(self.sample_size)
+            # Draw row positions and keep them in index order
+            pos = self.rng.choice(len(filt_index), size=self.sample_size,
+                                  replace=False)
+            self.cur_index = filt_index.iloc[np.sort(pos)]
         else:
             self.cur_index = filt_index
 
     def download_filings_sub(self, index=None, raw=False, text_only=True,
-                             chunk_size=100, show_progress=True, **kwargs):
+                             chunk_size=100, show_progress=True,
+                             csv_fname=None, splitter=None, **kwargs):
         """Process download requests in chunks.
 
         The method will execute the following steps:
@@ -124,17 +193,28 @@ class Search(object):
             4. Fix broken image paths in documents
             5. Delete temporary .txt files
             6. Store information about stored documents
+            7. Append the information to csv_fname, if given
+        The next chunk is downloaded in a background thread while the
+        current chunk is processed.
 
         Args:
             urls (list of str): URLs of EDGAR filings to process.
             index (pandas dataframe): Index dataframe to be downloaded.
-                If none, self.cur_index will be used. Defaults to None.
+                If none, self.cur_index will be used (the index is downloaded
+                first if necessary). Defaults to None.
             raw (bool): If true, the original .txt files from the EDGAR server
                 will be stored. If false, the containing documents will be
                 extracted and stored. Defaults to False.
             chunk_size (int): Number of filings to process in only iteration.
                 The bigger the chunk, the bigger the temporary file cache.
                 Defaults to 100.
+            csv_fname (str, optional): Path of a CSV file for the information
+                about the stored documents. The rows of every chunk are
+                appended as soon as the chunk is processed. Defaults to None.
+            splitter (concurrent.futures.ProcessPoolExecutor, optional):
+                Process pool used to split the filings. Pass a pool to reuse
+                its workers across calls. If None, a pool is spawned for the
+                call. Defaults to None.
         Keyword Args:
             text_only (bool): If True, only html and txt files are saved.
                 All other (media) files are discarded. Defaults to True.
@@ -154,20 +234,25 @@ class Search(object):
 
         """
         if index is None:
+            if not hasattr(self, "cur_index"):
+                self.download_index()
             df = self.cur_index
         else:
             df = index
 
         # Check if chunk_size is reasonable and adjust if not
         length = df.shape[0]
-        if chunk_size > length:
-            chunk_size = length
-
-        # Create chunks and prepare empty output DataFrames
-        c_list = [df.iloc[i:i + chunk_size, :]
-                  for i in range(0, length, chunk_size)]
-        final_tmp_f = pd.DataFrame()
-        final_docs = pd.DataFrame()
+        chunk_size = max(min(chunk_size, length), 1)
+
+        # Create chunks by grouping on the row position, which splits the
+        # frame in one pass instead of slicing it once per chunk
+        c_list = [chunk for _, chunk
+                  in df.groupby(np.arange(length) // chunk_size, sort=False)]
+        # Extract the urls once for all chunks
+        urls = df["File Name"].tolist()
+        # Prepare lists for the output of each chunk
+        tmp_parts = []
+        self._doc_parts = []
 
         # Print information to user
         if show_progress:
@@ -176,28 +261,98 @@ class Search(object):
                   % (len(c_list), chunk_size))
             print("Progress:")
 
-        # Iterate over chunks, while showing a progess bar
-        for index_chunk in tqdm(c_list, disable=(not show_progress)):
-            # Download the files from the server
-            batch = fb.Batch(index_chunk, dir_work=self.dir_work,
-                             sub_filings=self.sub_filings,
-                             edgar_url=self.edgar_url,
-                             show_progress=show_progress,
-                             **kwargs)
-            batch.download()
-
-            # If raw is False, process the downloaded filins
-            if raw is False:
-                batch.splitfiles(**kwargs)
-                documents = batch.docs
-                batch.replace_img()
-                batch.delete_tempfiles()
-                final_docs = pd.concat([final_docs, documents])
-            tmp_files = batch.temp_files
-            final_tmp_f = pd.concat([final_tmp_f, tmp_files])
-
-        self.temp_files = final_tmp_f
-        self.docs = final_docs
+        # Share one thread pool for the downloads of all chunks, so threads
+        # are not recreated per chunk (SEC allows ~10 requests per second)
+        pool = ThreadPoolExecutor(max_workers=10)
+        # Downloaded batches waiting to be processed. The bound keeps the
+        # downloader from running far ahead and filling the disk.
+        batches = queue.Queue(maxsize=2)
+        # Delete the temporary files in the background, so that slow file
+        # systems do not hold up the processing of the next chunk
+        io_pool = ThreadPoolExecutor(max_workers=4)
+        deletions = []
+        # Split the filings in worker processes. The workers are spawned, as
+        # forking while the download threads are running is not safe.
+        own_splitter = None
+        if raw is False and splitter is None:
+            own_splitter = ProcessPoolExecutor(
+                mp_context=mp.get_context("spawn"))
+            splitter = own_splitter
+        # Tells the producer to stop, when the main thread gives up early
+        stop = threading.Event()
+
+        def produce():
+            """Download the chunks and hand them over to the main thread."""
+            try:
+                for i, index_chunk in enumerate(c_list):
+                    if stop.is_set():
+                        return
+                    # The chunks were cut by row position in steps of
+                    # chunk_size, so chunk i holds these urls
+                    pos = i * chunk_size
+                    batch = fb.Batch(index_chunk, dir_work=self.dir_work,
+                                     sub_filings=self.sub_filings,
+                                     edgar_url=self.edgar_url,
+                                     show_progress=show_progress,
+                                     executor=pool,
+                                     url_list=urls[pos:pos + chunk_size],
+                                     session=self.session,
+                                     **kwargs)
+                    batch.download()
+                    batches.put(batch)
+            except Exception as e:
+                batches.put(e)
+            else:
+                batches.put(None)
+
+        # Download chunk k+1 in the background while chunk k is processed
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            # Iterate over chunks, while showing a progess bar
+            for batch in tqdm(iter(batches.get, None), total=len(c_list),
+                              disable=(not show_progress)):
+                if isinstance(batch, Exception):
+                    raise batch
+
+                # If raw is False, process the downloaded filins
+                if raw is False:
+                    batch.splitfiles(text_only=text_only, executor=splitter,
+                                     **kwargs)
+                    documents = batch.docs
+                    batch.replace_img()
+                    deletions.append(io_pool.submit(batch.delete_tempfiles))
+                    # Stream the rows of this chunk to the CSV file; only the
+                    # first chunk (re)creates the file and writes the header
+                    if csv_fname is not None:
+                        documents.to_csv(csv_fname, encoding="utf-8",
+                                         mode="a" if self._doc_parts else "w",
+                                         header=not self._doc_parts)
+                    self._doc_parts.append(documents)
+                tmp_parts.append(batch.temp_files)
+        finally:
+            # Stop the producer and empty the queue, so that a blocked put
+            # returns; the pools must outlive the chunk it is working on
+            stop.set()
+            while producer.is_alive():
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    producer.join(0.1)
+            pool.shutdown()
+            io_pool.shutdown()
+            if own_splitter is not None:
+                own_splitter.shutdown()
+
+        # Surface errors raised while deleting the temporary files
+        for deletion in deletions:
+            deletion.result()
+
+        # Concatenate once instead of growing the DataFrames per chunk
+        self.temp_files = (pd.concat(tmp_parts) if tmp_parts
+                           else pd.DataFrame())
+        if csv_fname is not None and not self._doc_parts:
+            self.docs.to_csv(csv_fname, encoding="utf-8")
 
     def download_filings(self, safemode_type="num",
                          safemode_val=10000, **kwargs):
@@ -238,16 +393,52 @@ class Search(object):
         Raises:
             None
 
+        """
+        if not hasattr(self, "cur_index"):
+            self.download_index()
+        # Spawn the split workers once for all periods, starting them costs
+        # far more than splitting a small period
+        splitter = None
+        if kwargs.get("raw", False) is False:
+            splitter = ProcessPoolExecutor(mp_context=mp.get_context("spawn"))
+        try:
+            self._download_periods(safemode_type, safemode_val,
+                                   splitter=splitter, **kwargs)
+        finally:
+            if splitter is not None:
+                splitter.shutdown()
+
+    def _download_periods(self, safemode_type, safemode_val, **kwargs):
+        """Download the filings of cur_index split into safe mode periods.
+
+        Args:
+            safemode_type (str): Safe mode, see download_filings.
+            safemode_val (int): Value for the safe mode,
+                see download_filings.
+            **kwargs: Keyword arguments passed on to download_filings_sub.
+
+        Returns:
+            None
+
+        Raises:
+            None
+
         """
         fulldf = self.cur_index
+        if safemode_type in ("years", "months"):
+            # Sort by date once, so that every period is a contiguous slice
+            # which can be located by binary search on the dates
+            fulldf = fulldf.sort_values("date", kind="mergesort")
+            dates = fulldf["date"]
+
         if safemode_type == "num":
             # Split sample into subsamples based on sample size
-            for x in range(0, fulldf.shape[0], safemode_val):
-                limit = min(fulldf.shape[0], x + safemode_val)
-                tempdf = fulldf.iloc[x:limit, :]
+            n = len(fulldf)
+            for x in range(0, n, safemode_val):
+                limit = min(n, x + safemode_val)
+                tempdf = fulldf.iloc[x:limit]
                 tqdm.write("Download sample %s-%s from total sample(size: %s)"
-                           % (x, limit, fulldf.shape[0]))
-                self.download_filings_sub(index=tempdf, **kwargs)
+                           % (x, limit, n))
                 fname = (
                     "filings_"
                     + str(x)
@@ -255,8 +446,9 @@ class Search(object):
                     + str(limit)
                     + ".csv"
                 )
-                self.docs.to_csv(self.dir_work + fname, encoding="utf-8")
-
+                self.download_filings_sub(index=tempdf,
+                                          csv_fname=self.dir_work + fname,
+                                          **kwargs)
         elif safemode_type == "years":
             # Split sample into subsamples based on years in sample period
             year_s = self.sample_start.year
@@ -264,16 +456,11 @@ class Search(object):
             for period in range(year_s, year_e + 1, safemode_val):
 
                 end_year = min(year_e, period + safemode_val - 1)
-                tempdf = fulldf.loc[((fulldf.date >= str(period)) &
-                                     (fulldf.date <= str(end_year + 1)))]
+                lo, hi = dates.searchsorted([pd.Timestamp(period, 1, 1),
+                                             pd.Timestamp(end_year + 1, 1, 1)])
+                tempdf = fulldf.iloc[lo:hi]
                 tqdm.write("Download sample %s-%s from total sample %s-%s"
                            % (period, end_year, year_s, year_e))
-                self.download_filings_sub(index=tempdf, **kwargs)
-                self.docs.to_csv("filings_"
-                                 + str(period)
-                                 + "_"
-                                 + str(end_year)
-                                 + ".csv")
                 if period == end_year:
                     fname = "filings_" + str(period) + ".csv"
                 else:
@@ -284,57 +471,43 @@ class Search(object):
                         + str(end_year)
                         + ".csv"
                     )
-                self.docs.to_csv(self.dir_work + fname, encoding="utf-8")
+                self.download_filings_sub(index=tempdf,
+                                          csv_fname=self.dir_work + fname,
+                                          **kwargs)
         elif safemode_type == "months":
-            # Split sample into subsamples based on months in sample period
-            starty = self.sample_start.year
-            startm = self.sample_start.month
-            endy = self.sample_end.year
-            endm = self.sample_end.month
-            startdate = str(starty) + "-" + str(startm).zfill(2)
-            enddate = str(endy) + "-" + str(endm).zfill(2)
-            for year in range(starty, endy + 1):
-                if year != starty:
-                    start = 1
+            # Split sample into subsamples of safemode_val months each,
+            # starting with the first month of the sample period
+            first = pd.Timestamp(self.sample_start.year,
+                                 self.sample_start.month, 1)
+            last = (pd.Timestamp(self.sample_end.year,
+                                 self.sample_end.month, 1)
+                    + pd.DateOffset(months=1))
+            starts = pd.date_range(first, last, freq="%sMS" % safemode_val)
+            starts = starts[starts < last]
+            stops = list(starts[1:]) + [last]
+            startdate = first.strftime("%Y-%m")
+            enddate = self.sample_end.strftime("%Y-%m")
+            for period_start, period_stop in zip(starts, stops):
+                start = period_start.strftime("%Y-%m")
+                stop_d = ((period_stop - pd.DateOffset(months=1))
+                          .strftime("%Y-%m"))
+                print("%s - %s" % (start, stop_d))
+
+                lo, hi = dates.searchsorted([period_start, period_stop])
+                tempdf = fulldf.iloc[lo:hi]
+                tqdm.write(("Download filings of period %s - %s from "
+                           "total sample period %s - %s")
+                           % (start, stop_d, startdate, enddate))
+                if start == stop_d:
+                    fname = "filings_" + str(start) + ".csv"
                 else:
-                    start = startm
-
-                if year != endy:
-                    end = 13
-                else:
-                    end = endm + 1
-                for month in range(start, end, safemode_val):
-                    limit = min(end, month + safemode_val)
-                    start = str(year) + "-" + str(month).zfill(2)
-                    if limit < 13:
-                        stop = str(year) + "-" + str(limit).zfill(2)
-                    else:
-                        stop = str(year + 1) + "-" + str(limit - 12).zfill(2)
-
-                    limit_d = min(end, month + safemode_val) - 1
-                    if limit_d < 13:
-                        stop_d = str(year) + "-" + str(limit_d).zfill(2)
-                    else:
-                        stop_d = (str(year + 1)
-                                  + "-"
-                                  + str(limit_d - 12).zfill(2)
-                                  )
-                    print("%s - %s" % (start, stop_d))
-
-                    tempdf = fulldf.loc[((fulldf.date >= str(start)) &
-                                         (fulldf.date < str(stop)))]
-                    tqdm.write(("Download filings of period %s - %s from "
-                               "total sample period %s - %s")
-                               % (start, stop_d, startdate, enddate))
-                    self.download_filings_sub(index=tempdf, **kwargs)
-                    if start == stop_d:
-                        fname = "filings_" + str(start) + ".csv"
-                    else:
-                        fname = (
-                            "filings_"
-                            + str(start)
-                            + "_"
-                            + str(stop_d)
-                            + ".csv"
-                        )
-                    self.docs.to_csv(self.dir_work + fname, encoding="utf-8")
+                    fname = (
+                        "filings_"
+                        + str(start)
+                        + "_"
+                        + str(stop_d)
+                        + ".csv"
+                    )
+                self.download_filings_sub(index=tempdf,
+                                          csv_fname=self.dir_work + fname,
+                                          **kwargs)
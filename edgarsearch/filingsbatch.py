@@ -15,19 +15,31 @@ Example:
 
 """
 import pandas as pd
-import multiprocessing as mp
 import edgarsearch.mpworker as mpw
 import edgarsearch.tools as t
+import binascii
 import re
-import uu
 import os
 import datetime
+import functools
 import itertools
-import io
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
 
+# Patterns used to split the filings, compiled once at import
+_HEADER_RE = re.compile(b"<SEC-HEADER>.*</SEC-HEADER>", re.DOTALL)
+_DOC_META_RE = re.compile(b"<TYPE>(?P<TYPE>.+?)[\\n]+?"
+                          b"<SEQUENCE>(?P<SEQ>.+?)[\\n]+"
+                          b"<FILENAME>(?P<FNAME>.+?)[\\n]"
+                          b"(<DESCRIPTION>(?P<DESC>.+?)[\\n])?",
+                          re.MULTILINE)
+_SEG_RE = re.compile(b"<DOCUMENT>|<TEXT>\n|</TEXT")
+# Characters removed from company names in filenames
+_COMPANY_TRANS = str.maketrans("", "", " ,./\\")
+
+
 class Batch(object):
     """Batch of filings.
 
@@ -45,6 +57,22 @@ class Batch(object):
             Defaults to 30 seconds.
         attempts (int): Number of tries to download files
             Defaults to 3.
+        max_concurrent (int): Maximum number of downloads in flight at the
+            same time if no executor is passed. SEC asks for no more than 10
+            requests per second. Defaults to 10.
+        executor (concurrent.futures.Executor, optional): Thread pool used
+            to run the downloads. Pass a pool to reuse its threads across
+            batches; its size limits the downloads in flight. If None, a
+            pool of max_concurrent threads is created for every download
+            attempt. Defaults to None.
+        url_list (list of str, optional): "File Name" column of index_slice,
+            if the caller already has it. Must have one entry per row of
+            index_slice. If None, it is read from index_slice.
+            Defaults to None.
+        session (requests.Session, optional): Session shared by all
+            downloads, so that connections to the server are reused. If None,
+            the batch creates its own with mpworker.make_session and a
+            connection pool of max_concurrent connections. Defaults to None.
 
     """
 
@@ -52,9 +80,12 @@ class Batch(object):
                  dir_work="edgar/", sub_filings="filings/",
                  edgar_url="https://www.sec.gov/Archives/",
                  timeout_limit=30, sleep_between_attempts=5,
-                 attempts_max=3, **kwargs):
+                 attempts_max=3, max_concurrent=10,
+                 executor=None, url_list=None, session=None, **kwargs):
         """Class construnctor."""
         self.index_slice = index_slice
+        # Index the slice by filing once, the downloads are joined on it
+        self._index_by_file = index_slice.set_index("File Name", drop=False)
         self.show_progress = show_progress
         self.dir_work = dir_work
         self.sub_filings = sub_filings
@@ -62,9 +93,19 @@ class Batch(object):
         self.timeout_limit = timeout_limit
         self.attempts_max = attempts_max
         self.sleep_between_attempts = sleep_between_attempts
+        self.max_concurrent = max_concurrent
+        self.executor = executor
+        if session is None:
+            session = mpw.make_session(pool_maxsize=max_concurrent)
+        self.session = session
 
         # List of str from filings index slice
-        self.url_list = index_slice["File Name"].tolist()
+        if url_list is None:
+            url_list = index_slice["File Name"].tolist()
+        elif len(url_list) != len(index_slice):
+            raise ValueError("url_list must have one url per row of "
+                             "index_slice")
+        self.url_list = url_list
 
     def collect(self, result):
         """Collect the results from the worker.
@@ -113,17 +154,8 @@ class Batch(object):
         # three then try to download
         while (len(self.results) < len(self.url_list) and
                attempt < self.attempts_max - 1):
-            # Use multiprocessing pool to download files
-            mplist = list(itertools.product(urls_queue,
-                                            [self.edgar_url],
-                                            [self.dir_work],
-                                            [self.sub_filings],
-                                            ))
-            pool = mp.Pool()
-            for x in mplist:
-                pool.apply_async(mpw.singledownload, x, callback=self.collect)
-            pool.close()
-            pool.join()
+            # Download the files concurrently; the work is network-bound
+            self._download_all(urls_queue)
 
             # Check if errors occured and deal with these
             if len(self.errors) > 0:
@@ -157,24 +189,75 @@ class Batch(object):
                                                     "temp_fname",
                                                     "dt_accessed",
                                                     ])
-            self.temp_files = self.temp_files.merge(self.index_slice,
-                                                    left_on="url",
-                                                    right_on="File Name")
+            self.temp_files = self.temp_files.join(self._index_by_file,
+                                                   on="url",
+                                                   how="inner")
         except Exception as e:
             tqdm.write(e)
         # Close the second (lower) progress bar
         if self.show_progress:
             self.bar.close()
 
-    def splitfiles(self, text_only=True, **kwargs):
+    def _download_all(self, urls):
+        """Download a list of urls concurrently.
+
+        Every download runs the blocking worker in the batch's executor, or
+        in a thread pool of max_concurrent threads owned by the call if the
+        batch has no executor. Results are passed to collect as they
+        complete.
+
+        Args:
+            urls (list of str): Relative paths on the EDGAR server.
+
+        Returns:
+            None
+
+        Raises:
+            None
+
+        """
+        executor = self.executor
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=self.max_concurrent)
+        try:
+            futures = [executor.submit(self._fetch_one, url) for url in urls]
+            for future in as_completed(futures):
+                self.collect(future.result())
+        finally:
+            if executor is not self.executor:
+                executor.shutdown()
+
+    def _fetch_one(self, url):
+        """Download a single filing with the settings of the batch.
+
+        Args:
+            url (str): Relative path on the EDGAR server.
+
+        Returns:
+            result (list): Output from the singledownload worker.
+
+        Raises:
+            None
+
+        """
+        return mpw.singledownload(url, self.edgar_url, self.dir_work,
+                                  self.sub_filings, self.timeout_limit,
+                                  self.session)
+
+    def splitfiles(self, text_only=True, executor=None, **kwargs):
         """Extract the original documents from the temporary file from EDGAR.
 
         The archieved filings on EDGAR contain multiple files bundled in a
         .txt-file. This method splits the files into its original components.
+        The filings are independent of each other and can be split in
+        parallel by passing a process pool.
 
         Args:
             text_only (bool): If True, only html and txt files are saved.
                 All other (media) files are discarded. Defaults to True.
+            executor (concurrent.futures.Executor, optional): Process pool
+                used to split the filings. If None, the filings are split in
+                the current process. Defaults to None.
             **kwargs: Arbitrary keyword arguments.
 
         Returns:
@@ -184,82 +267,42 @@ class Batch(object):
             None
 
         """
-        result = pd.DataFrame(columns=["url",
-                                       "seq",
-                                       "server_fname",
-                                       "type",
-                                       "desc",
-                                       "local_fname",
-                                       ])
-        # Iterate over all documents to split files
-        for index, row in self.temp_files.iterrows():
-            # Get get filename and make sure path exists
-            temp_fname = self.dir_work + self.sub_filings + row["temp_fname"]
-            fname_part = create_filename(row, **kwargs)
+        rows = []
+        # Get filenames for all filings and make sure the paths exist. Each
+        # directory is listed once and the names are reserved in memory, so
+        # that filings split at the same time do not end up with the same
+        # name.
+        tasks = []
+        listings = {}
+        fname_parts = build_filenames(self.temp_files, **kwargs)
+        for row, fname_part in zip(self.temp_files.itertuples(index=False),
+                                   fname_parts):
+            temp_fname = self.dir_work + self.sub_filings + row.temp_fname
             fname_full = self.dir_work + self.sub_filings + str(fname_part)
-            fname_full = t.finduniquefname(fname_full, exact=False, **kwargs)
             path = os.path.dirname(fname_full)
-            if os.path.isdir(path) is False:
-                os.makedirs(path)
-
-            # Open the temporary file and read the content
-            with open(temp_fname) as f:
-                txt = f.read()
-
-            # Extract the filing metadata, write to file & append to DataFrame
-            m_sec_header = re.search("<SEC-HEADER>.*</SEC-HEADER>",
-                                     txt,
-                                     re.DOTALL)
-            b_sec_header = m_sec_header.group(0)
-            local_fname = fname_full + "header.txt"
-            with open(local_fname, "w") as out:
-                out.write(b_sec_header)
-
-            result.loc[result.shape[0]] = ([row["url"],
-                                            0,
-                                            "HEADER",
-                                            "SEC Header",
-                                            "Header file",
-                                            local_fname])
-
-            # Extract all other document parts
-            splits = txt.split("<DOCUMENT>")[1:]
-            # For each documents path: Extract information, save to file and
-            # append to dataframe; depending on text_only only save text or all
-            # information
-            for i in splits:
-                text_startpos = i.find("<TEXT>\n") + 7
-                text_endpos = i.find("</TEXT") - 1
-                text = i[text_startpos:text_endpos]
-
-                search = ("<TYPE>(?P<TYPE>.+?)[\\n]+?"
-                          "<SEQUENCE>(?P<SEQ>.+?)[\\n]+"
-                          "<FILENAME>(?P<FNAME>.+?)[\\n]"
-                          "(<DESCRIPTION>(?P<DESC>.+?)[\\n])?")
-                try:
-                    info = re.search(search, i, re.MULTILINE).groupdict()
-                except:
-                    print(i)
-                    break
-                if info["TYPE"] != "GRAPHIC":
-                    local_fname = fname_full + str(info["SEQ"]) + ".html"
-                    with open(local_fname, "w") as out:
-                        out.write(text)
-                else:
-                    if text_only is True:
-                        break
-                    local_fname = fname_full + str(info["SEQ"]) + ".jpg"
-                    f = io.BytesIO(bytes(text, encoding="ascii"))
-                    uu.decode(f, local_fname, quiet=True)
-                    f.close()
-
-                result.loc[result.shape[0]] = ([row["url"],
-                                               info["SEQ"],
-                                               info["FNAME"],
-                                               info["TYPE"],
-                                               info["DESC"],
-                                               local_fname])
-        self.docs = result
+            if path not in listings:
+                os.makedirs(path, exist_ok=True)
+                listings[path] = sorted(os.listdir(path))
+            fname_full = t.reservefname(fname_full, listings[path],
+                                        exact=False, **kwargs)
+            tasks.append((temp_fname, fname_full, row.url, text_only))
+
+        # Split the filings and append the documents to the DataFrame
+        if executor is None:
+            records = itertools.starmap(_split_one, tasks)
+        else:
+            # Hand the filings to the workers a few at a time to save
+            # round trips between the processes
+            records = executor.map(_split_one, *zip(*tasks), chunksize=4)
+        for filing in records:
+            rows.extend(filing)
+        self.docs = pd.DataFrame.from_records(rows, columns=["url",
+                                                             "seq",
+                                                             "server_fname",
+                                                             "type",
+                                                             "desc",
+                                                             "local_fname",
+                                                             ])
 
     def replace_img(self):
         """Replace image path in documents with local filename.
@@ -274,20 +317,30 @@ class Batch(object):
             None
 
         """
-        for url in self.docs.url.unique():
-            extract_full = self.docs.loc[self.docs.url == url]
-            extract_graphic = extract_full.loc[extract_full.type == "GRAPHIC"]
-            extract_other = extract_full.loc[extract_full.type != "GRAPHIC"]
-            if extract_graphic.shape[0] > 0:
-                for index, row in extract_other.iterrows():
-                    with open(row["local_fname"], "r") as f:
-                        txt = f.read()
-                    local = extract_graphic.local_fname.values
-                    server = extract_graphic.server_fname.values
-                    for i in range(len(local)):
-                        txt = txt.replace(server[i], local[i].split("/")[-1])
-                    with open(row["local_fname"], "w") as f:
+        docs = self.docs
+        is_graphic = docs.type == "GRAPHIC"
+        # Local names are referenced without the path, strip it once
+        graphics = docs.loc[is_graphic].assign(
+            basename=lambda g: g.local_fname.str.rsplit("/", n=1).str[-1])
+        others = docs.loc[~is_graphic & docs.url.isin(graphics.url)]
+        other_fnames = others.groupby("url", sort=False).local_fname.agg(list)
+        for url, group in graphics.groupby("url", sort=False):
+            # Replace all image names of the filing in a single pass. Longer
+            # names come first, so that names containing others win.
+            table = {server.encode("utf-8"): local.encode("utf-8")
+                     for server, local in zip(group.server_fname,
+                                              group.basename)}
+            pattern = re.compile(b"|".join(
+                re.escape(server)
+                for server in sorted(table, key=len, reverse=True)))
+            for fname in other_fnames.get(url, []):
+                with open(fname, "r+b") as f:
+                    txt, count = pattern.subn(lambda m: table[m.group(0)],
+                                              f.read())
+                    if count > 0:
+                        f.seek(0)
                         f.write(txt)
+                        f.truncate()
 
     def delete_tempfiles(self):
         """Delete temporary raw downloaded files.
@@ -302,13 +355,165 @@ class Batch(object):
             None
 
         """
-        for index, row in self.temp_files.iterrows():
-            fname = self.dir_work + self.sub_filings + row["temp_fname"]
+        # Nothing was downloaded, the directory may not even exist
+        if self.temp_files.empty:
+            return None
+        path = self.dir_work + self.sub_filings
+        # Where supported, unlink relative to the opened directory, so the
+        # path is only resolved once for all files
+        dir_fd = None
+        if os.unlink in os.supports_dir_fd:
+            dir_fd = os.open(path, os.O_RDONLY)
+            path = ""
+        try:
+            for temp_fname in self.temp_files["temp_fname"]:
+                try:
+                    os.unlink(path + temp_fname, dir_fd=dir_fd)
+                except OSError:
+                    time.sleep(3)
+                    os.unlink(path + temp_fname, dir_fd=dir_fd)
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+
+
+def _split_one(temp_fname, fname_full, url, text_only=True):
+    """Split a single filing into its original documents.
+
+    Args:
+        temp_fname (str): Path of the temporary file downloaded from EDGAR.
+        fname_full (str): Path and filename prefix for the documents.
+        url (str): Relative path of the filing on the EDGAR server.
+        text_only (bool): If True, only html and txt files are saved.
+            All other (media) files are discarded. Defaults to True.
+
+    Returns:
+        records (list of list): One entry per stored document with the
+            url, sequence, server filename, type, description and local
+            filename.
+
+    Raises:
+        None
+
+    """
+    records = []
+    # Open the temporary file and read the raw content. The documents are
+    # written as they are, so the filing is never decoded as a whole.
+    with open(temp_fname, "rb") as f:
+        txt = f.read()
+
+    # Extract the filing metadata, write to file & append to records
+    m_sec_header = _HEADER_RE.search(txt)
+    b_sec_header = m_sec_header.group(0)
+    local_fname = fname_full + "header.txt"
+    with open(local_fname, "wb") as out:
+        out.write(b_sec_header)
+
+    records.append([url,
+                    0,
+                    "HEADER",
+                    "SEC Header",
+                    "Header file",
+                    local_fname])
+
+    # For each document: Extract information, save to file and append to
+    # records; depending on text_only only save text or all information
+    for match, text in _iter_documents(txt):
+        if match is None:
+            tqdm.write("Could not parse document in %s" % url)
+            break
+        info = {key: None if value is None else value.decode("utf-8")
+                for key, value in match.groupdict().items()}
+        if info["TYPE"] != "GRAPHIC":
+            local_fname = fname_full + str(info["SEQ"]) + ".html"
+            with open(local_fname, "wb") as out:
+                out.write(text)
+        else:
+            if text_only is True:
+                break
+            local_fname = fname_full + str(info["SEQ"]) + ".jpg"
+            _uudecode(text, local_fname)
+
+        records.append([url,
+                        info["SEQ"],
+                        info["FNAME"],
+                        info["TYPE"],
+                        info["DESC"],
+                        local_fname])
+    return records
+
+
+def _uudecode(data, out_fname):
+    """Decode a uuencoded file.
+
+    Replaces uu.decode, which parses in pure Python and is removed from the
+    standard library in Python 3.13.
+
+    Args:
+        data (bytes-like): uuencoded content including the begin line.
+        out_fname (str): Path of the decoded file.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If no begin line is found.
+
+    """
+    lines = bytes(data).splitlines()
+    for start, line in enumerate(lines):
+        if line.startswith(b"begin "):
+            break
+    else:
+        raise ValueError("No valid begin line found in input file")
+    with open(out_fname, "wb") as out:
+        for line in lines[start + 1:]:
+            if line.strip() == b"end":
+                break
             try:
-                os.remove(fname)
-            except:
-                time.sleep(3)
-                os.remove(fname)
+                out.write(binascii.a2b_uu(line))
+            except binascii.Error:
+                # Some encoders pad lines with garbage, only decode as many
+                # bytes as the length character announces
+                nbytes = (((line[0] - 32) & 63) * 4 + 5) // 3
+                out.write(binascii.a2b_uu(line[:nbytes]))
+
+
+def _iter_documents(txt):
+    """Locate the documents bundled in a filing.
+
+    The filing is scanned once for the document and text delimiters, instead
+    of splitting it into copies per document and searching each copy again.
+
+    Args:
+        txt (bytes): Raw content of the filing.
+
+    Yields:
+        match (re.Match or None): Metadata of the document, None if it
+            could not be parsed.
+        text (memoryview): Content between the <TEXT> tags of the document,
+            without copying it out of txt.
+
+    Raises:
+        None
+
+    """
+    view = memoryview(txt)
+    doc_start = text_start = None
+    for m in _SEG_RE.finditer(txt):
+        tag = m.group(0)
+        if tag == b"<DOCUMENT>":
+            doc_start, text_start = m.end(), None
+        elif doc_start is None:
+            continue
+        elif tag == b"<TEXT>\n":
+            if text_start is None:
+                text_start = m.end()
+        elif text_start is not None:
+            # The metadata is located between <DOCUMENT> and <TEXT>
+            match = _DOC_META_RE.search(txt, doc_start, text_start)
+            yield match, view[text_start:m.start() - 1]
+            doc_start = None
 
 
 def create_filename(row, fname_form="%Y%m%d_%company_", **kwargs):
@@ -338,18 +543,121 @@ def create_filename(row, fname_form="%Y%m%d_%company_", **kwargs):
     org = splits[2] + "_" + splits[3].split(".")[0]
 
     # Extract unwanted characters from the company name
-    company = (row["Company Name"]
-               .replace(" ", "")
-               .replace(",", "")
-               .replace(".", "")
-               .replace("/", "")
-               .replace("\\", "")
-               .lower()
-               )
+    company = row["Company Name"].translate(_COMPANY_TRANS).lower()
     # Replace the parameters with real values
-    fname = fname_form.replace("%org", org).replace("%company", company)
     tdate = datetime.datetime.strptime(row["Date Filed"], "%Y-%m-%d")
-    while fname.find("%") >= 0:
-        char = "%" + fname[fname.find("%") + 1]
-        fname = fname.replace(char, tdate.strftime(char))
+    values = {"org": org, "company": company}
+    fname = ""
+    for kind, value in _compile_fname_form(fname_form):
+        if kind == "literal":
+            fname += value
+        elif kind == "date":
+            fname += tdate.strftime(value)
+        else:
+            fname += values[kind]
     return fname
+
+
+def build_filenames(df, fname_form="%Y%m%d_%company_", **kwargs):
+    """Create the filenames for all filings in a DataFrame at once.
+
+    Vectorized version of create_filename. Every part of the filename format
+    is computed for the whole column in one go instead of row by row.
+
+    Args:
+         df (pandas DataFrame): Contains the columns "Date Filed",
+            "Company Name" and "url".
+         fname_form (str): String with the filename format.
+            See create_filename for the possible parameters.
+            Defaults to "%Y%m%d_%company_".
+         **kwargs: Arbitrary keyword arguments.
+
+    Returns:
+         fnames (pandas Series): The filenames, aligned with df's index.
+
+    Raises:
+        None
+
+    """
+    fnames = pd.Series("", index=df.index, dtype=object)
+    if df.empty:
+        return fnames
+    parts = _compile_fname_form(fname_form)
+    kinds = {kind for kind, value in parts}
+    values = {}
+    if "org" in kinds:
+        splits = df["url"].str.split("/", expand=True)
+        values["org"] = splits[2] + "_" + splits[3].str.split(".").str[0]
+    if "company" in kinds:
+        values["company"] = (df["Company Name"]
+                             .str.translate(_COMPANY_TRANS)
+                             .str.lower()
+                             )
+    if "date" in kinds:
+        tdate = pd.to_datetime(df["Date Filed"], format="%Y-%m-%d",
+                               cache=True)
+    for kind, value in parts:
+        if kind == "literal":
+            fnames = fnames + value
+        elif kind == "date":
+            fnames = fnames + tdate.dt.strftime(value)
+        else:
+            fnames = fnames + values[kind]
+    return fnames
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_fname_form(fname_form):
+    """Parse a filename format into its parts.
+
+    The format is parsed once and cached, so that creating the filenames of
+    many filings does not scan the format string again for every filing.
+
+    Args:
+         fname_form (str): String with the filename format.
+            See create_filename for the possible parameters.
+
+    Returns:
+         parts (tuple of tuple): (kind, value) pairs in order of appearance.
+            kind is "literal" for plain text, "org" and "company" for the
+            respective parameters and "date" for a strftime pattern made of
+            consecutive date directives and plain text.
+
+    Raises:
+        None
+
+    """
+    parts = []
+    # Date directives and the plain text between them are collected into
+    # one strftime pattern, so that a single strftime call formats them
+    literal = pattern = ""
+    has_date = False
+
+    def flush():
+        if has_date:
+            parts.append(("date", pattern))
+        elif literal:
+            parts.append(("literal", literal))
+
+    pos = 0
+    while pos < len(fname_form):
+        if fname_form.startswith("%org", pos):
+            part, pos = ("org", None), pos + 4
+        elif fname_form.startswith("%company", pos):
+            part, pos = ("company", None), pos + 8
+        elif fname_form[pos] == "%" and pos + 1 < len(fname_form):
+            pattern += fname_form[pos:pos + 2]
+            has_date = True
+            pos += 2
+            continue
+        else:
+            literal += fname_form[pos]
+            pattern += fname_form[pos].replace("%", "%%")
+            pos += 1
+            continue
+        flush()
+        literal = pattern = ""
+        has_date = False
+        parts.append(part)
+    flush()
+    return tuple(parts)
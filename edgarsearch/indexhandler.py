@@ -8,12 +8,28 @@ Functions in this module:
     download
     consolidates
     filter
+    read_index_file
 """
 
-import urllib.request
-import urllib.error
 import os.path
+import re
+import numpy as np
 import pandas as pd
+import requests
+import edgarsearch.mpworker as mpw
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+
+# Index files are stored as <year>_<quarter>.txt
+_INDEX_FNAME_RE = re.compile(r"^(\d{4})_([1-4])\.txt$")
+# Fixed-width layout of the rows in EDGAR's form.idx files
+_INDEX_FIELDS = [("Form Type", 12),
+                 ("Company Name", 62),
+                 ("CIK", 12),
+                 ("Date Filed", 12),
+                 ("File Name", 52),
+                 ]
 
 
 class EdgarIndex(object):
@@ -25,23 +41,36 @@ class EdgarIndex(object):
         dir_work (str): Path to working directory.
         sub_index (str): Path to subdirectory in working directory.
         edgar_url (str): URL to EDGAR archive parent folder on server.
+        session (requests.Session, optional): Session used for the requests.
+            If None, a session from mpworker.make_session is created.
+        timeout_limit (int): Timeout in seconds for a single index file
+            request.
+        from_cache (bool): True if the last consolidate call loaded the
+            index from the parquet cache instead of parsing the index files.
 
     """
 
     def __init__(self, sample_start, sample_end,
-                 dir_work, sub_index, edgar_url):
+                 dir_work, sub_index, edgar_url, session=None,
+                 timeout_limit=30):
         """Class construnctor."""
         self.sample_start = sample_start
         self.sample_end = sample_end
         self.dir_work = dir_work
         self.sub_index = sub_index
         self.edgar_url = edgar_url
+        if session is None:
+            session = mpw.make_session()
+        self.session = session
+        self.timeout_limit = timeout_limit
+        self.from_cache = False
 
-    def download(self):
+    def download(self, show_progress=True):
         """Download index files from the EDGAR database.
 
         Args:
-            None
+            show_progress (bool): If true, a progressbar on index file level
+                will be displayed. Defaults to True.
 
         Returns:
             None
@@ -53,60 +82,87 @@ class EdgarIndex(object):
         url_start = "edgar/full-index/"
         url_end = "/form.idx"
 
-        # Exclude quarters which are not in sample
-        start_excl = []
-        if self.sample_start.month > 3:
-            start_excl.append(1)
-        if self.sample_start.month > 6:
-            start_excl.append(2)
-        if self.sample_start.month > 9:
-            start_excl.append(3)
-
-        end_excl = []
-        if self.sample_end.month < 10:
-            end_excl.append(4)
-        if self.sample_end.month < 7:
-            end_excl.append(3)
-        if self.sample_end.month < 4:
-            end_excl.append(2)
-
-        # For each quarter in each year in sample, check whether quarter is in
-        # sample. If so download the index file if it does not already exist
-        for year in range(self.sample_start.year, self.sample_end.year + 1):
-            for quarter in range(1, 5):
-                if (year == self.sample_start.year) & (quarter in start_excl):
-                    continue
-                elif (year == self.sample_end.year) & (quarter in end_excl):
-                    continue
-                else:
-                    url = (self.edgar_url
-                           + url_start
-                           + str(year)
-                           + "/QTR"
-                           + str(quarter)
-                           + url_end
-                           )
-                    fname = (self.dir_work
-                             + self.sub_index
-                             + str(year)
-                             + "_"
-                             + str(quarter)
-                             + ".txt"
-                             )
-                    if os.path.isdir(os.path.dirname(fname)) is False:
-                        os.makedirs(os.path.dirname(fname))
-                    if os.path.isfile(fname) is False:
-                        try:
-                            urllib.request.urlretrieve(url, fname)
-                        except urllib.error.HTTPError as e:
-                            if e.code == 404:
-                                print(("%s not on server!", url))
-                            else:
-                                print(e)
+        # All index files are stored in the same directory
+        path = self.dir_work + self.sub_index
+        os.makedirs(path, exist_ok=True)
+
+        # Download the index file of each quarter in sample if it does not
+        # already exist
+        downloads = []
+        for year, quarter in _iter_quarters(_quarter(self.sample_start),
+                                            _quarter(self.sample_end)):
+            url = (self.edgar_url
+                   + url_start
+                   + str(year)
+                   + "/QTR"
+                   + str(quarter)
+                   + url_end
+                   )
+            fname = (path
+                     + str(year)
+                     + "_"
+                     + str(quarter)
+                     + ".txt"
+                     )
+            if os.path.isfile(fname) is False:
+                downloads.append((url, fname))
+        if not downloads:
+            return None
+
+        # The index files are independent, fetch them concurrently over the
+        # shared session
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for _ in tqdm(executor.map(self._fetch, *zip(*downloads)),
+                          total=len(downloads),
+                          disable=(not show_progress or not downloads)):
+                pass
+
+    def _fetch(self, url, fname):
+        """Download a single index file.
+
+        Args:
+            url (str): URL of the index file on the server.
+            fname (str): Local filename of the index file.
+
+        Returns:
+            None
+
+        Raises:
+            None
+
+        """
+        # Stream into a temporary file and move it into place once complete,
+        # so that an aborted download is fetched again on the next run
+        part_fname = fname + ".part"
+        try:
+            with self.session.get(url, timeout=self.timeout_limit,
+                                  stream=True) as response:
+                response.raise_for_status()
+                with open(part_fname, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=1 << 16):
+                        f.write(chunk)
+            os.replace(part_fname, fname)
+        except requests.HTTPError as e:
+            if e.response.status_code == 404:
+                tqdm.write("%s not on server!" % url)
+            else:
+                tqdm.write(str(e))
+        except requests.RequestException as e:
+            tqdm.write(str(e))
+        finally:
+            if os.path.isfile(part_fname):
+                os.remove(part_fname)
 
     def consolidate(self):
         """Consolidate index files and filter for desired form type.
 
+        Only the index files of the quarters in the sample are consolidated,
+        even if the working directory holds index files of a longer period.
+        The consolidated index is cached as a parquet file per range of
+        quarters next to the index files and reused as long as no index file
+        is newer than the cache. Caching is skipped if no parquet engine
+        (e.g. pyarrow) is installed.
+
         Args:
             None
 
@@ -117,22 +173,105 @@ class EdgarIndex(object):
             None
 
         """
-        index_files = os.listdir(self.dir_work + self.sub_index)
-        result = pd.DataFrame()
+        path = self.dir_work + self.sub_index
+        first = _quarter(self.sample_start)
+        last = _quarter(self.sample_end)
+        cache = path + "consolidated_%sQ%s_%sQ%s.parquet" % (first + last)
+        index_files = self._index_files()
 
         if len(index_files) == 0:
             print("No index files found. Download index files first")
             return None
 
-        for indexf in index_files:
-            indexdf = pd.read_fwf(self.dir_work + self.sub_index + indexf,
-                                  widths=[12, 62, 12, 12, 52],
-                                  skiprows=8,
-                                  comment="---")
-            indexdf["date"] = pd.to_datetime(indexdf["Date Filed"])
-            result = result.append(indexdf)
-
+        # Reuse the cached index if it is up to date
+        newest = max(os.path.getmtime(path + f) for f in index_files)
+        if os.path.isfile(cache) and os.path.getmtime(cache) >= newest:
+            try:
+                self.cons_index = pd.read_parquet(cache)
+                self.from_cache = True
+                return None
+            except Exception:
+                # No parquet engine or a damaged cache, parse the index
+                # files instead
+                pass
+
+        frames = [read_index_file(path + indexf) for indexf in index_files]
+        result = pd.concat(frames, ignore_index=True)
+        # CIKs are matched as integers against the CIK filter. They are
+        # positive and fit into the smallest unsigned type, usually uint32.
+        result["CIK"] = pd.to_numeric(result["CIK"], downcast="unsigned")
+        # EDGAR dates are always ISO formatted, and filings share few dates
+        result["date"] = pd.to_datetime(result["Date Filed"],
+                                        format="%Y-%m-%d",
+                                        cache=True)
+
+        self.from_cache = False
+        # Form types repeat a lot, store them as codes into a small table.
+        # Converted after concat, as differing categories would fall back
+        # to object dtype.
+        result["Form Type"] = result["Form Type"].astype("category")
         self.cons_index = result
+        # Write to a temporary file first, so that an interrupted write never
+        # leaves a damaged cache that looks up to date
+        try:
+            result.to_parquet(cache + ".part", compression="zstd")
+            os.replace(cache + ".part", cache)
+        except ImportError:
+            pass
+        finally:
+            if os.path.isfile(cache + ".part"):
+                os.remove(cache + ".part")
+
+    def fingerprint(self):
+        """Identify the current state of the index files in sample.
+
+        The fingerprint changes whenever an index file of the sample is added
+        or rewritten, so that results derived from the consolidated index
+        can be reused as long as it is unchanged.
+
+        Args:
+            None
+
+        Returns:
+            tuple: Sorted names of the index files in sample and the newest
+                modification time among them (None if there are none).
+
+        Raises:
+            None
+
+        """
+        path = self.dir_work + self.sub_index
+        index_files = sorted(self._index_files())
+        newest = None
+        if index_files:
+            newest = max(os.path.getmtime(path + f) for f in index_files)
+        return tuple(index_files), newest
+
+    def _index_files(self):
+        """List the downloaded index files of the quarters in sample.
+
+        Args:
+            None
+
+        Returns:
+            list of str: File names in the index directory.
+
+        Raises:
+            None
+
+        """
+        path = self.dir_work + self.sub_index
+        first = _quarter(self.sample_start)
+        last = _quarter(self.sample_end)
+        index_files = []
+        for indexf in os.listdir(path):
+            match = _INDEX_FNAME_RE.match(indexf)
+            if match is None:
+                continue
+            quarter = (int(match.group(1)), int(match.group(2)))
+            if first <= quarter <= last:
+                index_files.append(indexf)
+        return index_files
 
     def filter(self, sample_start, sample_end, filter_formtype, filter_CIK):
         """Filter the index based on date, form type and/or CIK.
@@ -142,7 +281,7 @@ class EdgarIndex(object):
             sample_end (datetime): End date for the filings in sample.
             filter_formtype (list of str, optional): SEC form types to include.
                 None deactives the filter. Defaults to none.
-            filter_CIK (list of str, optional): Company CIKs to include.
+            filter_CIK (set of int, optional): Company CIKs to include.
                 None deactives the filter. Defaults to None.
 
         Returns:
@@ -152,16 +291,105 @@ class EdgarIndex(object):
             None
 
         """
+        index = self.cons_index
         # Filter based on sample period
-        filterdf = self.cons_index.loc[(self.cons_index.date >= sample_start) &
-                                       (self.cons_index.date <= sample_end)]
+        mask = (index.date >= sample_start) & (index.date <= sample_end)
 
         # Filter based on form type
         if filter_formtype is not None:
-            filterdf = filterdf[filterdf["Form Type"].isin(filter_formtype)]
+            mask &= index["Form Type"].isin(filter_formtype)
 
         # Filter based on CIK
         if filter_CIK is not None:
-            filterdf = filterdf[filterdf["CIK"].isin(filter_CIK)]
+            mask &= index["CIK"].isin(filter_CIK)
 
+        # Select the rows once for the combined filters
+        filterdf = index.loc[mask]
         self.filtered_index = filterdf
+
+
+def _quarter(date):
+    """Return the quarter of a date.
+
+    Args:
+        date (datetime): Any date.
+
+    Returns:
+        quarter (tuple of int): Year and quarter (1-4) of date.
+
+    Raises:
+        None
+
+    """
+    return (date.year, (date.month - 1) // 3 + 1)
+
+
+def _iter_quarters(first, last):
+    """Iterate over the quarters from first to last, both included.
+
+    Args:
+        first (tuple of int): Year and quarter to start with.
+        last (tuple of int): Year and quarter to end with.
+
+    Yields:
+        quarter (tuple of int): Year and quarter (1-4).
+
+    Raises:
+        None
+
+    """
+    year, quarter = first
+    while (year, quarter) <= last:
+        yield year, quarter
+        if quarter == 4:
+            year, quarter = year + 1, 1
+        else:
+            quarter += 1
+
+
+def read_index_file(fname):
+    """Parse an EDGAR form.idx file.
+
+    The rows have fixed column widths. They are padded into one fixed-size
+    numpy bytes array, which is then viewed as a record per row, so the
+    columns are cut out without parsing the rows one by one. Only the
+    stripped fields are decoded. The widths are counted in characters, so
+    the rare files which are not pure ASCII are cut as text instead.
+
+    Args:
+        fname (str): Path to the index file.
+
+    Returns:
+        indexdf (pandas DataFrame): The columns "Form Type", "Company Name",
+            "CIK" (int64), "Date Filed" and "File Name".
+
+    Raises:
+        None
+
+    """
+    with open(fname, "rb") as f:
+        is_ascii = f.read().isascii()
+    if is_ascii:
+        f, kind, dashes = open(fname, "rb"), "S", b"---"
+    else:
+        f, kind, dashes = open(fname, encoding="utf-8"), "U", "---"
+    layout = np.dtype([(name, "%s%s" % (kind, width))
+                       for name, width in _INDEX_FIELDS])
+    row_width = sum(width for _, width in _INDEX_FIELDS)
+    with f:
+        # The rows start after the dashed line below the column headers
+        for line in f:
+            if line.startswith(dashes):
+                break
+        rows = np.fromiter((line.rstrip() for line in f if line.strip()),
+                           dtype="%s%s" % (kind, row_width))
+    records = rows.view(layout)
+    columns = {}
+    for name in layout.names:
+        values = np.char.strip(records[name]).tolist()
+        if kind == "S":
+            values = [value.decode() for value in values]
+        columns[name] = pd.Series(values, dtype=str)
+    indexdf = pd.DataFrame(columns)
+    indexdf["CIK"] = records["CIK"].astype("int64")
+    return indexdf
@@ -8,18 +8,174 @@ Examples:
     with different folder structure:
     singledownload("edgar/data/1645148/0001213900-15-004775.txt",
                    folder="myfolder/", sub="")
+    many filings concurrently:
+    download_many(["edgar/data/1645148/0001213900-15-004775.txt",
+                   "edgar/data/1645148/0001213900-15-004776.txt"])
 
 """
-import urllib.request
-import uuid
 import datetime
 import os
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class RateLimiter(object):
+    """Limit the rate of requests shared by many threads.
+
+    Requests are spaced evenly, so that no more than max_rate requests per
+    second are started. SEC throttles clients above 10 requests per second.
+
+    Attributes:
+        max_rate (float): Maximum number of requests per second.
+
+    """
+
+    def __init__(self, max_rate=8):
+        """Class constructor."""
+        self.max_rate = max_rate
+        self._interval = 1.0 / max_rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next request may be started.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class ThrottledAdapter(HTTPAdapter):
+    """HTTPAdapter which passes every request through a RateLimiter.
+
+    Attributes:
+        limiter (RateLimiter, optional): Limiter shared by all requests sent
+            through the adapter. None disables the throttling.
+
+    """
+
+    def __init__(self, limiter=None, **kwargs):
+        """Class constructor."""
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        """Wait for the limiter, then send the request."""
+        if self.limiter is not None:
+            self.limiter.wait()
+        return super().send(request, **kwargs)
+
+
+def make_retry():
+    """Create the retry policy for requests to the EDGAR server.
+
+    Throttled requests and server errors are retried with exponential
+    backoff, honouring the Retry-After header sent with a 429.
+
+    Args:
+        None
+
+    Returns:
+        retries (urllib3.util.retry.Retry): The retry policy.
+
+    Raises:
+        None
+
+    """
+    return Retry(total=5, backoff_factor=1.0,
+                 status_forcelist=[429, 500, 502, 503, 504],
+                 respect_retry_after_header=True)
+
+
+# SEC asks automated tools to declare themselves in the User-Agent header
+USER_AGENT = "edgarsearch (+https://github.com/markdembo/edgarsearch)"
+
+
+def make_session(user_agent=USER_AGENT, max_rate=8, pool_maxsize=10):
+    """Create a session for requests to the EDGAR server.
+
+    The session keeps connections to the server alive, stays below the
+    server's rate limit and retries requests which were throttled or failed
+    on the server.
+
+    Args:
+        user_agent (str): User-Agent header sent with every request.
+            Defaults to USER_AGENT.
+        max_rate (float, optional): Maximum number of requests per second.
+            None disables the limit. Defaults to 8.
+        pool_maxsize (int): Maximum number of connections kept alive.
+            Should be at least the number of threads sharing the session.
+            Defaults to 10.
+
+    Returns:
+        session (requests.Session): Pooled and throttled session with
+            retries.
+
+    Raises:
+        None
+
+    """
+    limiter = None if max_rate is None else RateLimiter(max_rate)
+    adapter = ThrottledAdapter(limiter=limiter, pool_maxsize=pool_maxsize,
+                               max_retries=make_retry())
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"User-Agent": user_agent})
+    return session
+
+
+# Session shared by downloads without a session of their own. It is created
+# lazily per process, as connections must not be shared across a fork.
+_SESSION = None
+_SESSION_PID = None
+
+
+def _get_session():
+    """Return the shared session of the current process.
+
+    Args:
+        None
+
+    Returns:
+        session (requests.Session): Pooled and throttled session with
+            retries.
+
+    Raises:
+        None
+
+    """
+    global _SESSION, _SESSION_PID
+    if _SESSION is None or _SESSION_PID != os.getpid():
+        _SESSION, _SESSION_PID = make_session(pool_maxsize=32), os.getpid()
+    return _SESSION
 
 
 def singledownload(url, edgar_url="https://www.sec.gov/Archives/",
-                   folder="data/", sub="filings/", timeout=30):
+                   folder="data/", sub="filings/", timeout=30, session=None):
     """Download filings from the EDGAR database.
 
+    The local filename is derived from the CIK and accession number in the
+    url, so it is unique per filing. Filings that were already downloaded
+    completely are not downloaded again.
+
     Args:
         url (str): Relative path on the EDGAR server.
         edgar_url (str): URL to EDGAR archive parent folder on server.
@@ -30,6 +186,10 @@ def singledownload(url, edgar_url="https://www.sec.gov/Archives/",
         timeout (int): Number of seconds to wait for the download to complete
             before the download attempt is counted as failed.
             Defaults to 30 seconds.
+        session (requests.Session, optional): Session used for the request,
+            so that connections are reused across downloads. If None, a
+            pooled session shared within the process is used.
+            Defaults to None.
 
     Returns:
         result (list): Information on which was downloaded, the local filename
@@ -40,24 +200,63 @@ def singledownload(url, edgar_url="https://www.sec.gov/Archives/",
 
     """
     full_url = edgar_url + url
-    fname = str(uuid.uuid4()) + ".txt"
+    fname = "_".join(url.split("/")[-2:])
+    out_dir = folder + sub
     accessed = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    if session is None:
+        session = _get_session()
+    if os.path.isfile(out_dir + fname):
+        return [url, fname, accessed]
+
+    # Stream the response to disk as it arrives. The filing is stored as
+    # raw bytes, it is neither held in memory as a whole nor decoded. It
+    # only gets its final name once it is complete.
+    part_fname = out_dir + fname + ".part"
     try:
-        txt = urllib.request.urlopen(full_url, timeout=timeout).read()
+        with session.get(full_url, timeout=timeout,
+                         stream=True) as response:
+            response.raise_for_status()
+            # The directory usually exists, only create it when it is missing
+            try:
+                f = open(part_fname, "wb")
+            except FileNotFoundError:
+                os.makedirs(out_dir, exist_ok=True)
+                f = open(part_fname, "wb")
+            with f:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    f.write(chunk)
+        os.replace(part_fname, out_dir + fname)
     except Exception as e:
-        return [url, e, "Error"]
-
-    if os.path.isdir(folder + sub) is False:
+        # Do not leave a partially downloaded file behind
         try:
-            os.makedirs(folder + sub)
-        except Exception as e:
-            print(e)
+            os.remove(part_fname)
+        except OSError:
+            pass
+        return [url, e, "Error"]
 
-    try:
-        f = open(folder + sub + fname, 'x')
-    except Exception:
-        f = open(folder + sub + fname, 'w+')
-    f.write(txt.decode('utf-8'))
-    f.close
     result = [url, fname, accessed]
     return result
+
+
+def download_many(urls, max_workers=16, **kwargs):
+    """Download many filings from the EDGAR database concurrently.
+
+    The downloads are network-bound, so they run in threads that share the
+    connection pool of one session.
+
+    Args:
+        urls (list of str): Relative paths on the EDGAR server.
+        max_workers (int): Number of concurrent downloads. Defaults to 16.
+        **kwargs: Keyword arguments passed on to singledownload.
+
+    Returns:
+        results (list of list): Output of singledownload for every url, in
+            the order of urls.
+
+    Raises:
+        None
+
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda url: singledownload(url, **kwargs),
+                                 urls))
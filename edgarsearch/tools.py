@@ -4,6 +4,7 @@ Consists of the following functions:
     * getalpha: Convert integer to alphabetic character.
     * finduniquefilename: Find unique name if a file with the original filename
                           already exists.
+    * reservefname: Find unique name against a directory listing in memory.
 
 
 Example:
@@ -18,15 +19,18 @@ Todo:
 
 """
 
+import bisect
+import functools
 import os
 import string
-import glob
 
 
+@functools.lru_cache(maxsize=None)
 def getalpha(x):
     """Convert integer to alphabetic character.
 
-    Assigns every integer to a alphabetic string.
+    Assigns every integer to a alphabetic string. Results are cached, as
+    the same suffixes are requested over and over.
     Examples for clarification:
         getalpha(0)  --> "A"
         getalpha(1)  --> "B"
@@ -73,36 +77,64 @@ def finduniquefname(fname, mode="alpha", exact=True, **kwargs):
         None
 
     """
-    i = 0
-    fpre, fsuf = os.path.splitext(fname)
-    if exact is True:
-        while os.path.isfile(fname):
-            if mode == "alpha":
-                fname = (
-                         fpre
-                         + getalpha(i)
-                         + fsuf
-                         )
-            elif mode == "num":
-                fname = (
-                         fpre
-                         + str(i)
-                         + fsuf
-                         )
-            i += 1
-    else:
-        while len(glob.glob(fname + "*")) > 0:
-            if mode == "alpha":
-                fname = (
-                         fpre
-                         + getalpha(i)
-                         + fsuf
-                         )
-            elif mode == "num":
-                fname = (
-                         fpre
-                         + str(i)
-                         + fsuf
-                         )
-            i += 1
+    # List the directory once instead of probing it for every candidate
+    names = []
+    try:
+        with os.scandir(os.path.dirname(fname) or ".") as entries:
+            for entry in entries:
+                if exact is False or entry.is_file():
+                    names.append(entry.name)
+    except FileNotFoundError:
+        pass
+    names.sort()
+    fname = reservefname(fname, names, mode=mode, exact=exact)
     return(fname)
+
+
+def reservefname(fname, names, mode="alpha", exact=True, **kwargs):
+    """Find unique name against a directory listing held in memory.
+
+    Works like finduniquefname, but looks the name up in a sorted listing
+    instead of the file system. The returned name is added to the listing,
+    so that following calls treat it as taken.
+
+    Args:
+        fname (String): Filename (incl. path) to be checked
+        names (list of String): Sorted filenames in the directory of fname.
+            Updated in place.
+        mode (String): Sets the mode for creating unique filenames.
+            Possible values:
+            * "alpha" will add alphabetical suffixes
+            * "num"  will add numerical suffixes
+            default("alpha")
+        exact (Bool): If true, checks for the exact file name.
+            If false, checks for the filename pattern
+        **kwargs: Arbitrary keyword arguments.
+
+    Returns:
+        fname (String): Unique filename
+
+    Raises:
+        None
+
+    """
+    def taken(name):
+        # Names starting with name follow it directly in sorted order
+        pos = bisect.bisect_left(names, name)
+        if pos == len(names):
+            return False
+        if exact is True:
+            return names[pos] == name
+        return names[pos].startswith(name)
+
+    path, base = os.path.split(fname)
+    bpre, bsuf = os.path.splitext(base)
+    i = 0
+    while taken(base):
+        if mode == "alpha":
+            base = bpre + getalpha(i) + bsuf
+        elif mode == "num":
+            base = bpre + str(i) + bsuf
+        i += 1
+    bisect.insort(names, base)
+    return os.path.join(path, base)
@@ -11,7 +11,12 @@ setup(name="edgarsearch",
       license="MIT",
       packages=["edgarsearch"],
       install_requires=[
+          "numpy",
           "pandas",
+          "requests",
           "tqdm"
       ],
+      extras_require={
+          "parquet": ["pyarrow"]
+      },
       )